@@ -1,3 +1,7 @@
 from .config.config import Config, LabConfig  # noqa
 from .db.db import DB  # noqa
-from .cml import LabDef, CML  # noqa
+from .cml import LabDef, get_node_cost, CML, AddressDiscovery, RequestLimiter, configure_requests, configure_requests_from  # noqa
+from .capacity import CapacityIndex  # noqa
+from .archive.index import ArchiveIndex  # noqa
+from .simulation import Simulation, load_timings  # noqa
+from .profiling import JobProfiler  # noqa
@@ -0,0 +1,151 @@
+from sqlalchemy import create_engine, text
+import os
+from yaml import load
+
+try:
+    from yaml import CLoader as Loader
+except ImportError:
+    from yaml import Loader
+
+ARCHIVE_TABLE = "archive"
+CONFIG_TABLE = "node_config"
+ARCHIVE_FILE = "lab.yaml"
+# The jump-host's cloud-config holds the student's password, and external connectors have no config of their own.
+SKIP_NODES = ["jump-host"]
+SKIP_NODE_DEFINITIONS = ["external_connector"]
+
+SCHEMA = [
+    f"CREATE TABLE IF NOT EXISTS {ARCHIVE_TABLE} (path TEXT PRIMARY KEY NOT NULL, lab TEXT NOT NULL, student TEXT, \
+    mtime REAL NOT NULL)",
+    f"CREATE INDEX IF NOT EXISTS ix_{ARCHIVE_TABLE}_lab_student ON {ARCHIVE_TABLE} (lab, student)",
+    # Only the config text is tokenized; the other columns are stored to filter and report on matches.
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {CONFIG_TABLE} USING \
+    fts5(path UNINDEXED, lab UNINDEXED, student UNINDEXED, node UNINDEXED, config)",
+]
+
+
+class ArchiveIndex(object):
+    """
+    Full-text index (SQLite FTS5) over the node configurations saved in lab archives.  Each archive is recorded with
+    its modification time so update() only has to re-read archives that have changed.
+    """
+
+    def __init__(self, filename):
+        self._db_engine = create_engine(f"sqlite:///{filename}", connect_args={"timeout": 30})
+        with self._db_engine.connect() as conn:
+            try:
+                for sql in SCHEMA:
+                    conn.execute(sql)
+
+                # Older indexes included the skipped nodes.
+                for node in SKIP_NODES:
+                    conn.execute(text(f"DELETE FROM {CONFIG_TABLE} WHERE node=:node"), node=node)
+            except Exception as e:
+                raise Exception(f"ERROR: Failed to create archive index (is SQLite built with FTS5?): {e}")
+
+    def add_archive(self, filename, lab=None, student=None):
+        """Index (or re-index) one archived lab file.  lab and student are read from the archive if not given."""
+        filename = os.path.abspath(filename)
+        mtime = os.path.getmtime(filename)
+        with open(filename, "rb") as fd:
+            archive = load(fd, Loader=Loader)
+
+        if not lab:
+            lab = archive["lab"]["title"]
+        if not student:
+            # Archives are written to <lab title>-<student>.
+            dirname = os.path.basename(os.path.dirname(filename))
+            if dirname.startswith(lab + "-"):
+                student = dirname.replace(lab + "-", "", 1)
+
+        configs = []
+        for node in archive.get("nodes", []):
+            if node["label"] in SKIP_NODES or node.get("node_definition") in SKIP_NODE_DEFINITIONS or not node.get("configuration"):
+                continue
+
+            configs.append({"path": filename, "lab": lab, "student": student, "node": node["label"], "config": node["configuration"]})
+
+        with self._db_engine.connect() as conn:
+            try:
+                with conn.begin():
+                    conn.execute(text(f"DELETE FROM {CONFIG_TABLE} WHERE path=:path"), path=filename)
+                    conn.execute(
+                        text(f"INSERT OR REPLACE INTO {ARCHIVE_TABLE} (path, lab, student, mtime) VALUES (:path, :lab, :student, :mtime)"),
+                        path=filename,
+                        lab=lab,
+                        student=student,
+                        mtime=mtime,
+                    )
+                    if len(configs) > 0:
+                        sql = f"INSERT INTO {CONFIG_TABLE} (path, lab, student, node, config) \
+                            VALUES (:path, :lab, :student, :node, :config)"
+                        conn.execute(text(sql), configs)
+            except Exception as e:
+                raise Exception(f"ERROR: Failed to index archive {filename}: {e}")
+
+    def update(self, archives_base):
+        """
+        Bring the index up to date with the archives under archives_base.  New and changed archives are indexed and
+        archives that no longer exist are dropped.  Returns the number of archives (re-)indexed.
+        """
+        with self._db_engine.connect() as conn:
+            try:
+                result = conn.execute(f"SELECT path, mtime FROM {ARCHIVE_TABLE}")
+            except Exception as e:
+                raise Exception(f"ERROR: Failed to read archive index: {e}")
+            else:
+                indexed = {row["path"]: row["mtime"] for row in result}
+
+        count = 0
+        for entry in os.scandir(archives_base):
+            filename = os.path.abspath(os.path.join(entry.path, ARCHIVE_FILE))
+            if not entry.is_dir() or not os.path.isfile(filename):
+                continue
+
+            if indexed.pop(filename, None) != os.path.getmtime(filename):
+                self.add_archive(filename)
+                count += 1
+
+        for filename in indexed:
+            self.remove_archive(filename)
+
+        return count
+
+    def remove_archive(self, filename):
+        with self._db_engine.connect() as conn:
+            try:
+                with conn.begin():
+                    conn.execute(text(f"DELETE FROM {CONFIG_TABLE} WHERE path=:path"), path=filename)
+                    conn.execute(text(f"DELETE FROM {ARCHIVE_TABLE} WHERE path=:path"), path=filename)
+            except Exception as e:
+                raise Exception(f"ERROR: Failed to remove archive {filename} from the index: {e}")
+
+    def search(self, query, node=None, lab=None, student=None, raw=False):
+        """
+        Return the lab, student, node, and config of every node config that matches query.  By default query is
+        matched as a phrase; with raw=True it is passed through as an FTS5 query expression.
+        """
+        if not raw:
+            query = '"' + query.replace('"', '""') + '"'
+
+        sql = f"SELECT lab, student, node, config FROM {CONFIG_TABLE} WHERE {CONFIG_TABLE} MATCH :query"
+        params = {"query": query}
+        if node:
+            sql += " AND node=:node"
+            params["node"] = node
+        if student:
+            sql += " AND student=:student"
+            params["student"] = student
+        if lab:
+            # Lab titles end in their start time, so match on the prefix to cover every run of a lab.
+            sql += " AND lab LIKE :lab"
+            params["lab"] = lab + "%"
+
+        sql += " ORDER BY lab, student, node"
+        with self._db_engine.connect() as conn:
+            try:
+                result = conn.execute(text(sql), **params)
+            except Exception as e:
+                raise Exception(f"ERROR: Failed to search archives: {e}")
+            else:
+                return [row for row in result]
@@ -0,0 +1,93 @@
+from bisect import bisect_left, bisect_right
+import itertools
+
+
+class CapacityIndex(object):
+    """
+    Interval index over lab time windows, weighted by node cost.  The index is kept as a step function:
+    a sorted list of boundary times and the total node load between each boundary and the next one.  A sparse
+    table over those loads answers "what is the peak load in this window?" in constant time.
+    """
+
+    def __init__(self, limit):
+        self._limit = limit
+        self._deltas = {}
+        self._times = []
+        self._loads = []
+        self._table = []
+        self._dirty = False
+
+    def add(self, start, end, cost):
+        if end <= start or cost <= 0:
+            return
+
+        self._deltas[start] = self._deltas.get(start, 0) + cost
+        self._deltas[end] = self._deltas.get(end, 0) - cost
+        self._dirty = True
+
+    def _build(self):
+        if not self._dirty:
+            return
+
+        self._times = sorted(self._deltas)
+        self._loads = list(itertools.accumulate(self._deltas[t] for t in self._times))
+        self._table = [self._loads]
+        width = 1
+        while width * 2 <= len(self._loads):
+            prev = self._table[-1]
+            self._table.append([max(prev[k], prev[k + width]) for k in range(len(prev) - width)])
+            width *= 2
+
+        self._dirty = False
+
+    def _range_max(self, i, j):
+        if i >= j:
+            return 0
+
+        level = (j - i).bit_length() - 1
+        row = self._table[level]
+        return max(row[i], row[j - (1 << level)])
+
+    def peak(self, start, end):
+        """Return the highest node load seen at any point in [start, end)."""
+        self._build()
+        i = bisect_right(self._times, start) - 1
+        j = bisect_left(self._times, end)
+        # A window that begins before anything is indexed starts out at zero load.
+        return self._range_max(max(i, 0), j)
+
+    def fits(self, start, end, cost):
+        return self.peak(start, end) + cost <= self._limit
+
+    def suggest(self, start, end, cost, count=3):
+        """
+        Return up to count start times at or after start where a window of the same length fits.  Labs are scheduled
+        to the minute, so every start time is on a whole minute.
+        """
+        if cost > self._limit:
+            return []
+
+        self._build()
+        length = end - start
+        slots = []
+        # The load can only drop at a boundary, so those are the only candidates worth checking.  Running labs end to
+        # the second, so boundaries are rounded up to the next minute.
+        first = bisect_right(self._times, start)
+        candidates = itertools.chain([start], self._times[first:])
+        last = None
+        for candidate in candidates:
+            candidate = -(-candidate // 60) * 60
+            if candidate == last:
+                continue
+
+            last = candidate
+            if self.fits(candidate, candidate + length, cost):
+                slots.append(candidate)
+                if len(slots) == count:
+                    break
+
+        return slots
+
+    @property
+    def limit(self):
+        return self._limit
@@ -1,10 +1,17 @@
 import os
+import copy
+import random
+import string
+import requests.exceptions
+from requests.adapters import HTTPAdapter
 from virl2_client import ClientLibrary
 from virl2_client.models.cl_pyats import ClPyats
 from virl2_client.exceptions import LabNotFound
 import logging
 import time
+import threading
 import concurrent.futures
+import functools
 from yaml import load
 
 try:
@@ -13,6 +20,304 @@ except ImportError:
     from yaml import Loader
 
 CONSOLE_BASE_PORT = 9000
+ADDRESS_POLL_INTERVAL = 1
+ADDRESS_TIMEOUT = 11
+# How long a lab's topology and status are reused by get_lab_status().
+TOPOLOGY_TTL = 300
+STATUS_TTL = 5
+# HTTP methods that are safe to send again if the controller fails or times out.
+IDEMPOTENT_METHODS = ["GET", "HEAD", "OPTIONS", "PUT", "DELETE"]
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+# (connect, read) timeout for requests sent without one, which is all of virl2_client's.
+REQUEST_TIMEOUT = (10, 120)
+
+_LIMITERS = {}
+_LIMITERS_LOCK = threading.Lock()
+# GETs in flight to each controller, shared by every CML object (and so every session) for that controller.  Requests
+# from different users never share a key since the key includes the Authorization header.
+_IN_FLIGHT = {}
+_IN_FLIGHT_LOCK = threading.Lock()
+
+_TEMPLATES = {}
+_TEMPLATES_LOCK = threading.Lock()
+# Node definitions that do not consume controller resources (or licenses).
+FREE_NODE_DEFINITIONS = ["external_connector", "unmanaged_switch"]
+
+
+class RequestLimiter(object):
+    """
+    Rate and concurrency control for requests to one controller.  A token bucket caps the request rate, while the
+    number of requests allowed in flight grows additively while the controller answers quickly and is halved when it
+    errors or its latency goes above target_latency.
+    """
+
+    def __init__(self, rate=20.0, burst=40, min_concurrency=2, max_concurrency=32, target_latency=2.0, retries=4, backoff=0.5):
+        self._rate = float(rate)
+        self._burst = burst
+        self._min_concurrency = min_concurrency
+        self._max_concurrency = max_concurrency
+        self._target_latency = target_latency
+        self._retries = retries
+        self._backoff = backoff
+        self._tokens = float(burst)
+        self._last_refill = time.monotonic()
+        self._limit = float(max(min_concurrency, max_concurrency // 2))
+        self._last_decrease = 0
+        self._in_flight = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self._burst, self._tokens + (now - self._last_refill) * self._rate)
+                self._last_refill = now
+                if self._in_flight < int(self._limit) and self._tokens >= 1:
+                    self._tokens -= 1
+                    self._in_flight += 1
+                    return
+
+                # Without a free slot we wait to be notified by release(); otherwise just until the next token.
+                wait = None
+                if self._in_flight < int(self._limit):
+                    wait = (1 - self._tokens) / self._rate
+                self._cond.wait(wait)
+
+    def release(self, latency, ok):
+        with self._cond:
+            self._in_flight -= 1
+            now = time.monotonic()
+            if not ok or latency > self._target_latency:
+                # Only back off once per target_latency so a burst of slow responses doesn't collapse the limit.
+                if now - self._last_decrease > self._target_latency:
+                    self._limit = max(self._min_concurrency, self._limit / 2)
+                    self._last_decrease = now
+            else:
+                self._limit = min(self._max_concurrency, self._limit + 1 / self._limit)
+
+            self._cond.notify_all()
+
+    def backoff(self, attempt):
+        # "Full jitter" exponential backoff.
+        return random.uniform(0, min(30, self._backoff * (2 ** attempt)))
+
+    @property
+    def retries(self):
+        return self._retries
+
+    @property
+    def concurrency(self):
+        return int(self._limit)
+
+    @property
+    def max_concurrency(self):
+        return self._max_concurrency
+
+
+def configure_requests(host, **kwargs):
+    """Replace the shared RequestLimiter for a controller.  kwargs are passed to RequestLimiter."""
+    with _LIMITERS_LOCK:
+        _LIMITERS[host] = RequestLimiter(**kwargs)
+        return _LIMITERS[host]
+
+
+def configure_requests_from(config):
+    """Replace the shared RequestLimiter for the configured controller with one using the config's request limits."""
+    return configure_requests(
+        config.cml_server, rate=config.cml_rate_limit, max_concurrency=config.cml_max_concurrency, retries=config.cml_retries
+    )
+
+
+def _get_limiter(host):
+    with _LIMITERS_LOCK:
+        if host not in _LIMITERS:
+            _LIMITERS[host] = RequestLimiter()
+
+        return _LIMITERS[host]
+
+
+def _get_in_flight(host):
+    with _IN_FLIGHT_LOCK:
+        return _IN_FLIGHT.setdefault(host, {})
+
+
+class LimitedAdapter(HTTPAdapter):
+    """
+    Transport adapter that sends every request through a RequestLimiter, retries idempotent requests that fail with
+    jittered backoff, and merges identical GETs that are already in flight into a single request.
+    """
+
+    def __init__(self, limiter, in_flight, timeout=REQUEST_TIMEOUT, **kwargs):
+        self._limiter = limiter
+        self._in_flight = in_flight
+        self._timeout = timeout
+        kwargs.setdefault("pool_maxsize", limiter.max_concurrency)
+        super().__init__(**kwargs)
+
+    def send(self, request, stream=False, **kwargs):
+        # A request that never returns would hold its slot in the limiter forever.
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self._timeout
+
+        if request.method != "GET" or stream:
+            return self._send(request, stream=stream, **kwargs)
+
+        key = (request.url, request.headers.get("Authorization"))
+        with _IN_FLIGHT_LOCK:
+            leader = key not in self._in_flight
+            if leader:
+                self._in_flight[key] = concurrent.futures.Future()
+            future = self._in_flight[key]
+
+        if not leader:
+            shared = future.result()
+            if not shared.ok:
+                # Errors (e.g., a 401 for an expired token) are handled by hooks that resend the request on the
+                # response's connection, so each waiter gets a response of its own.
+                return self._send(request, stream=stream, **kwargs)
+
+            response = copy.copy(shared)
+            # Pickling-based copies drop the connection the response came in on.
+            response.connection = shared.connection
+            return response
+
+        try:
+            response = self._send(request, stream=stream, **kwargs)
+            # Read the body now so every waiter gets the content.
+            response.content
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(response)
+            return response
+        finally:
+            with _IN_FLIGHT_LOCK:
+                del self._in_flight[key]
+
+    def _send(self, request, **kwargs):
+        idempotent = request.method in IDEMPOTENT_METHODS
+        attempt = 0
+        while True:
+            self._limiter.acquire()
+            start = time.monotonic()
+            try:
+                response = super().send(request, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                self._limiter.release(time.monotonic() - start, False)
+                if not idempotent or attempt >= self._limiter.retries:
+                    raise
+            else:
+                # Throttling (429) is as much a sign of overload as a server error.
+                ok = response.status_code < 500 and response.status_code not in RETRY_STATUSES
+                self._limiter.release(time.monotonic() - start, ok)
+                if not idempotent or attempt >= self._limiter.retries or response.status_code not in RETRY_STATUSES:
+                    return response
+
+                response.close()
+
+            time.sleep(self._limiter.backoff(attempt))
+            attempt += 1
+
+
+class LimitedClientLibrary(ClientLibrary):
+    """
+    ClientLibrary whose session sends every request through the controller's LimitedAdapter, including the ones made
+    while it is constructed (system_information, authenticate, and authok).
+    """
+
+    def __init__(self, host, *args, **kwargs):
+        self._adapter = LimitedAdapter(_get_limiter(host), _get_in_flight(host))
+        super().__init__(host, *args, **kwargs)
+
+    @property
+    def session(self):
+        # The session is created by the constructor, which reads it (to set verify) before it sends anything.
+        session = self._context.session
+        if self._adapter is not None:
+            session.mount("https://", self._adapter)
+            session.mount("http://", self._adapter)
+            self._adapter = None
+
+        return session
+
+
+class TTLCache(object):
+    """Small thread-safe cache whose entries expire ttl seconds after they were loaded."""
+
+    def __init__(self, ttl):
+        self._ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, loader):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > now:
+                return entry[1]
+
+        value = loader()
+        with self._lock:
+            self._entries[key] = (now + self._ttl, value)
+
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class ConfigTemplate(string.Template):
+    """
+    Node config template.  Placeholders are written as {{ name }}, since device configs are full of "$" (e.g., in
+    encrypted secrets) and must pass through untouched.
+    """
+
+    pattern = r"""
+    \{\{\s*(?:
+        (?P<braced>[_a-zA-Z][_a-zA-Z0-9]*)\s*\}\}|
+        (?P<escaped>(?!))|
+        (?P<named>(?!))|
+        (?P<invalid>(?!))
+    )
+    """
+
+
+def _load_templates(entries):
+    """Compile the given node config files.  Configs without placeholders are kept as plain strings."""
+    templates = {}
+    for entry in entries:
+        with open(entry.path, "r") as fd:
+            config = fd.read()
+
+        label = os.path.splitext(entry.name)[0]
+        if ConfigTemplate.pattern.search(config) is None:
+            templates[label] = config
+        else:
+            templates[label] = ConfigTemplate(config)
+
+    return templates
+
+
+def get_templates(cfg_dir):
+    """
+    Return the compiled node configs for a lab source, keyed by node label.  They are cached per directory and only
+    reloaded when a config is added, removed, or modified.
+    """
+    entries = [entry for entry in os.scandir(cfg_dir) if entry.is_file() and entry.name.endswith(".cfg")]
+    # Editing a file in place doesn't change the directory's mtime, so check every file's.
+    key = tuple(sorted((entry.name, entry.stat().st_mtime) for entry in entries))
+    with _TEMPLATES_LOCK:
+        cached = _TEMPLATES.get(cfg_dir)
+        if cached and cached[0] == key:
+            return cached[1]
+
+    templates = _load_templates(entries)
+    with _TEMPLATES_LOCK:
+        _TEMPLATES[cfg_dir] = (key, templates)
+
+    return templates
 
 
 class LabDef(object):
@@ -24,11 +329,26 @@ class LabDef(object):
             lab = load(fd, Loader=Loader)
 
             self.__title = lab["lab"]["title"]
+            self.__node_cost = len([n for n in lab.get("nodes", []) if n.get("node_definition") not in FREE_NODE_DEFINITIONS])
 
     @property
     def title(self):
         return self.__title
 
+    @property
+    def node_cost(self):
+        return self.__node_cost
+
+
+@functools.lru_cache(maxsize=None)
+def get_node_cost(labs_directory, source):
+    """Return the node cost of a lab source.  A lab definition may have been removed since it was scheduled; it then costs nothing."""
+    lfile = labs_directory + "/" + source + ".yaml"
+    if not os.path.isfile(lfile):
+        return 0
+
+    return LabDef(lfile).node_cost
+
 
 class CML(object):
     def __init__(self, host, username, password):
@@ -48,26 +368,50 @@ class CML(object):
         self._student = None
         self._student_password = None
         self._student_name = None
+        self._topologies = TTLCache(TOPOLOGY_TTL)
+        self._statuses = TTLCache(STATUS_TTL)
 
-        self._client = ClientLibrary(host, username, password, raise_for_auth_failure=True, ssl_verify=False)
+        self._client = LimitedClientLibrary(host, username, password, raise_for_auth_failure=True, ssl_verify=False)
         logger.setLevel(level)
 
     def import_lab(self, filename, title):
         lab = self._client.import_lab_from_path(filename, title=title)
         return lab.id
 
-    def configure_lab(self, lid, student, name, passwd, cfg_dir):
+    def configure_lab(self, lid, student, name, passwd, cfg_dir, variables=None):
         self._student = student
         self._student_password = passwd
         self._student_name = name
+        templates = get_templates(cfg_dir)
+        values = {"student": student, "student_name": name, "lab_id": lid}
+        values.update(variables or {})
         lab = self._client.join_existing_lab(lid)
         for node in lab.nodes():
-            if node.label == "jump-host":
+            if node.label == "jump-host" or node.label not in templates:
                 continue
-            nconfig = cfg_dir + "/" + node.label + ".cfg"
-            if os.path.isfile(nconfig):
-                with open(nconfig, "r") as fd:
-                    node.config = fd.read()
+
+            template = templates[node.label]
+            if isinstance(template, str):
+                node.config = template
+                continue
+
+            try:
+                node.config = template.substitute(values, node=node.label)
+            except KeyError as e:
+                raise Exception(f"ERROR: Unknown variable {e} in {cfg_dir}/{node.label}.cfg")
+
+    @staticmethod
+    def _console_ports(lab):
+        """Return (node, port) for each node the breakout utility serves, in the order the ports are assigned."""
+        ignore_nodes = ["jump-host", "Mgmt-net"]
+        consoles = []
+        for node in lab.nodes():
+            if node.label in ignore_nodes or node.node_definition == "external_connector":
+                continue
+
+            consoles.append((node, CONSOLE_BASE_PORT + len(consoles)))
+
+        return consoles
 
     def _configure_breakout(self, lab):
         jump_host = lab.get_node_by_label("jump-host")
@@ -102,14 +446,8 @@ write_files:
             lab_title: {lab.title}
             nodes:
 """
-        base_port = CONSOLE_BASE_PORT
-        i = 0
-        ignore_nodes = ["jump-host", "Mgmt-net"]
-        for node in lab.nodes():
-            if node.label in ignore_nodes or node.node_definition == "external_connector":
-                continue
-
-            self._consoles[node.label] = base_port + i
+        for node, port in CML._console_ports(lab):
+            self._consoles[node.label] = port
             config += f"""
                 {node.id}:
                     devices:
@@ -120,7 +458,6 @@ write_files:
                           status: ""
                     label: {node.label}
 """
-            i += 1
         config += f"""
       path: /etc/breakout/labs.yaml
     - content: |
@@ -165,23 +502,44 @@ runcmd:
             time.sleep(1)
 
     def get_lab_address(self, lid):
-        lab = self._client.join_existing_lab(lid)
-        jump_host = lab.get_node_by_label("jump-host")
-        mgmtip = None
-        retries = 0
-        while mgmtip is None:
-            if retries > 10:
-                break
-
-            for i in jump_host.interfaces():
-                if i.discovered_ipv4 and len(i.discovered_ipv4) > 0:
-                    mgmtip = i.discovered_ipv4[0]
-                    break
+        return self.discover_lab_addresses().get_lab_address(lid)
 
-            retries += 1
-            time.sleep(1)
+    def discover_lab_addresses(self, interval=ADDRESS_POLL_INTERVAL, timeout=ADDRESS_TIMEOUT):
+        return AddressDiscovery(self._client, interval=interval, timeout=timeout)
 
-        return mgmtip
+    def _load_topology(self, lid):
+        lab = self._client.join_existing_lab(lid)
+        # Only the states and addresses change while a lab runs, and get_lab_status() syncs those itself.
+        lab.auto_sync = False
+        return lab
+
+    def _load_status(self, lid):
+        lab = self._topologies.get(lid, lambda: self._load_topology(lid))
+        lab.sync_states()
+        lab.sync_layer3_addresses()
+        mgmtip = None
+        nodes = {}
+        for node in lab.nodes():
+            nodes[node.label] = node.state
+            if node.label == "jump-host":
+                for i in node.interfaces():
+                    if mgmtip is None and i.discovered_ipv4 and len(i.discovered_ipv4) > 0:
+                        mgmtip = i.discovered_ipv4[0]
+
+        return {
+            "nodes": nodes,
+            "booted": len([state for state in nodes.values() if state == "BOOTED"]),
+            "address": mgmtip,
+            "consoles": {node.label: port for node, port in CML._console_ports(lab)},
+        }
+
+    def get_lab_status(self, lid):
+        """Return the node states, jump-host address and console ports of a running lab (cached for STATUS_TTL seconds)."""
+        try:
+            return self._statuses.get(lid, lambda: self._load_status(lid))
+        except LabNotFound:
+            self._topologies.invalidate(lid)
+            raise
 
     def get_lab_consoles(self):
         if len(self._consoles) == 0:
@@ -263,3 +621,92 @@ runcmd:
             r.raise_for_status()
         except Exception as e:
             raise Exception(f"ERROR: Failed to remove student: {e}")
+
+
+class AddressDiscovery(object):
+    """
+    Find the jump-host address for many labs at once.  A single poller thread sweeps every lab still waiting on an
+    address once per interval (one layer3_addresses call per lab) and resolves each lab's future as soon as its
+    jump-host reports an IPv4 address.  A lab that has no address after its timeout resolves to None.
+    """
+
+    def __init__(self, client, interval=ADDRESS_POLL_INTERVAL, timeout=ADDRESS_TIMEOUT, max_workers=10):
+        self._client = client
+        self._interval = interval
+        self._timeout = timeout
+        self._max_workers = max_workers
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._poller = None
+
+    def request(self, lid, timeout=None):
+        with self._lock:
+            if lid in self._pending:
+                return self._pending[lid]["future"]
+
+            future = concurrent.futures.Future()
+            deadline = time.monotonic() + (timeout if timeout is not None else self._timeout)
+            self._pending[lid] = {"future": future, "deadline": deadline, "jump_host": None}
+            if self._poller is None:
+                self._poller = threading.Thread(target=self._poll, name="address-discovery", daemon=True)
+                self._poller.start()
+
+        return future
+
+    def get_lab_address(self, lid, timeout=None):
+        return self.request(lid, timeout=timeout).result()
+
+    def _check(self, lid, entry):
+        if entry["jump_host"] is None:
+            lab = self._client.join_existing_lab(lid)
+            entry["jump_host"] = lab.get_node_by_label("jump-host")
+            # The topology doesn't change while we wait, so only the explicit layer3_addresses sync below goes out.
+            lab.auto_sync = False
+
+        jump_host = entry["jump_host"]
+        jump_host.lab.sync_layer3_addresses()
+        for i in jump_host.interfaces():
+            if i.discovered_ipv4 and len(i.discovered_ipv4) > 0:
+                return i.discovered_ipv4[0]
+
+        return None
+
+    def _poll(self):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            while True:
+                with self._lock:
+                    if len(self._pending) == 0:
+                        self._poller = None
+                        return
+
+                    pending = dict(self._pending)
+
+                start = time.monotonic()
+                future_labs = {executor.submit(self._check, lid, entry): lid for lid, entry in pending.items()}
+                for fl in concurrent.futures.as_completed(future_labs):
+                    lid = future_labs[fl]
+                    entry = pending[lid]
+                    try:
+                        mgmtip = fl.result()
+                    except LabNotFound as e:
+                        self._resolve(lid, exception=e)
+                        continue
+                    except Exception:
+                        # Transient controller errors are retried on the next sweep until the lab times out.
+                        mgmtip = None
+
+                    if mgmtip is not None:
+                        self._resolve(lid, result=mgmtip)
+                    elif time.monotonic() >= entry["deadline"]:
+                        self._resolve(lid, result=None)
+
+                time.sleep(max(0, self._interval - (time.monotonic() - start)))
+
+    def _resolve(self, lid, result=None, exception=None):
+        with self._lock:
+            entry = self._pending.pop(lid)
+
+        if exception is not None:
+            entry["future"].set_exception(exception)
+        else:
+            entry["future"].set_result(result)
@@ -14,11 +14,19 @@ class Config(object):
         self._lab_dir = config.get("labs_directory")
         self._config_base = config.get("configs_base")
         self._archive_base = config.get("archives_base")
+        self._archive_index = config.get("archive_index")
         self._smtp_server = config.get("smtp_server")
         self._db_file = config.get("db_file")
         self._email_from = config.get("email_from")
         self._smtp_tls = config.get("smtp_tls", False)
         self._smtp_port = config.get("smtp_port", 25)
+        self._max_nodes = config.get("max_nodes")
+        self._profile_dir = config.get("profile_dir")
+        self._address_timeout = config.get("address_timeout", 11)
+        self._address_poll_interval = config.get("address_poll_interval", 1)
+        self._cml_rate_limit = config.get("cml_rate_limit", 20)
+        self._cml_max_concurrency = config.get("cml_max_concurrency", 32)
+        self._cml_retries = config.get("cml_retries", 4)
 
         if not all([self._host, self._username, self._password]):
             raise Exception(
@@ -35,6 +43,9 @@ class Config(object):
         if not self._archive_base or not os.path.isdir(self._archive_base):
             raise Exception("ERROR: archives_base has either not been specified or is not a directory")
 
+        if not self._archive_index:
+            self._archive_index = self._archive_base + "/index.db"
+
         if not self._smtp_server:
             raise Exception("ERROR: smtp_server has not been specified")
 
@@ -54,6 +65,25 @@ class Config(object):
         except TypeError:
             raise Exception("ERROR: smtp_port must be an integer")
 
+        if self._max_nodes is not None:
+            try:
+                self._max_nodes = int(self._max_nodes)
+            except (TypeError, ValueError):
+                raise Exception("ERROR: max_nodes must be an integer")
+
+        try:
+            self._address_timeout = float(self._address_timeout)
+            self._address_poll_interval = float(self._address_poll_interval)
+        except (TypeError, ValueError):
+            raise Exception("ERROR: address_timeout and address_poll_interval must be numbers of seconds")
+
+        try:
+            self._cml_rate_limit = float(self._cml_rate_limit)
+            self._cml_max_concurrency = int(self._cml_max_concurrency)
+            self._cml_retries = int(self._cml_retries)
+        except (TypeError, ValueError):
+            raise Exception("ERROR: cml_rate_limit, cml_max_concurrency, and cml_retries must be numbers")
+
     @property
     def cml_server(self):
         return self._host
@@ -78,6 +108,10 @@ class Config(object):
     def archives_base(self):
         return self._archive_base
 
+    @property
+    def archive_index(self):
+        return self._archive_index
+
     @property
     def smtp_server(self):
         return self._smtp_server
@@ -98,6 +132,34 @@ class Config(object):
     def smtp_port(self):
         return self._smtp_port
 
+    @property
+    def max_nodes(self):
+        return self._max_nodes
+
+    @property
+    def profile_dir(self):
+        return self._profile_dir
+
+    @property
+    def address_timeout(self):
+        return self._address_timeout
+
+    @property
+    def address_poll_interval(self):
+        return self._address_poll_interval
+
+    @property
+    def cml_rate_limit(self):
+        return self._cml_rate_limit
+
+    @property
+    def cml_max_concurrency(self):
+        return self._cml_max_concurrency
+
+    @property
+    def cml_retries(self):
+        return self._cml_retries
+
 
 class LabConfig(object):
     def __init__(self, filename):
@@ -1,7 +1,9 @@
-from sqlalchemy import create_engine, MetaData, Integer, Column, String, Enum, Text, Table
+from sqlalchemy import create_engine, inspect, MetaData, Integer, Column, String, Enum, Text, Table
+from collections import namedtuple
 import datetime
 
 LAB_TABLE = "lab"
+LAB_HISTORY_TABLE = "lab_history"
 STUDENT_TABLE = "student"
 
 TABLES = {
@@ -18,6 +20,21 @@ TABLES = {
         Column("student_password", String(8)),
         Column("schedule_id", String(36), index=True),
         Column("device_password", Text()),
+        # 1-based position of the lab within its schedule, set when it is scheduled.
+        Column("lab_index", Integer()),
+    ],
+    # Finished labs are moved here by compact_labs() so the lab table only holds labs that are still live.  Columns that
+    # have no meaning once a lab is gone (cid, status, and the passwords) are not kept.
+    LAB_HISTORY_TABLE: [
+        Column("id", Integer(), primary_key=True, autoincrement=True, nullable=False),
+        Column("lab_id", Integer(), nullable=False, index=True),
+        Column("title", String(255), nullable=False),
+        Column("student", String(16), nullable=True, index=True),
+        Column("source", String(255), nullable=False, index=True),
+        Column("start_time", Integer(), index=True, nullable=False),
+        Column("end_time", Integer()),
+        Column("duration", Integer(), nullable=False),
+        Column("schedule_id", String(36), index=True),
     ],
     STUDENT_TABLE: [
         Column("uname", String(16), primary_key=True, nullable=False),
@@ -26,6 +43,37 @@ TABLES = {
     ],
 }
 
+HISTORY_COLUMNS = "title, student, source, start_time, end_time, duration, schedule_id"
+ACTIVE_STATUSES = ("SCHEDULED", "SCHEDULING", "RUNNING")
+FETCH_BATCH_SIZE = 500
+
+_ROW_TYPES = {}
+
+
+def _row_getitem(self, item):
+    if isinstance(item, str):
+        return getattr(self, item)
+
+    return tuple.__getitem__(self, item)
+
+
+def _row_type(table, columns):
+    """
+    Return a tuple-backed row class for the given projection.  Rows can be indexed by position, by column name (like
+    the SQLAlchemy rows returned by the other getters), or accessed as attributes.
+    """
+    key = (table, columns)
+    if key not in _ROW_TYPES:
+        known = [c.name for c in TABLES[table]]
+        for column in columns:
+            if column not in known:
+                raise Exception(f"ERROR: Unknown column {column} in table {table}")
+
+        name = table.title().replace("_", "") + "Row"
+        _ROW_TYPES[key] = type(name, (namedtuple(name, columns),), {"__slots__": (), "__getitem__": _row_getitem})
+
+    return _ROW_TYPES[key]
+
 
 class DB(object):
     _db_engine = None
@@ -38,11 +86,64 @@ class DB(object):
             if not self._db_engine.dialect.has_table(self._db_engine, table):
                 missing_table = True
                 Table(table, metadata, *tdef)
+            else:
+                self._add_missing_columns(table, tdef)
 
         if missing_table:
             metadata.create_all()
 
-    def get_scheduled_labs(self, starting=None):
+    def _add_missing_columns(self, table, tdef):
+        """Add columns introduced since an existing table was created.  Such columns must be nullable."""
+        existing = [c["name"] for c in inspect(self._db_engine).get_columns(table)]
+        with self._db_engine.connect() as conn:
+            for column in tdef:
+                if column.name in existing:
+                    continue
+
+                try:
+                    conn.execute(f"ALTER TABLE {table} ADD COLUMN {column.name} {column.type.compile(self._db_engine.dialect)}")
+                except Exception as e:
+                    raise Exception(f"ERROR: Failed to add column {column.name} to {table}: {e}")
+
+    def iter_labs(self, columns, status=None, starting=None, ending=None, table=LAB_TABLE, batch_size=FETCH_BATCH_SIZE):
+        """
+        Stream labs a batch at a time, only fetching the given columns.  status may be a single status or a sequence of
+        them; starting and ending select labs whose start_time or end_time is at or before the given time.
+        """
+        columns = tuple(columns)
+        row_type = _row_type(table, columns)
+        where = []
+        if status:
+            if isinstance(status, str):
+                status = [status]
+            where.append("status IN (" + ", ".join(f"'{s}'" for s in status) + ")")
+        if starting:
+            where.append(f"start_time <= '{starting}'")
+        if ending:
+            where.append(f"end_time <= '{ending}'")
+
+        sql = f"SELECT {', '.join(columns)} from {table}"
+        if len(where) > 0:
+            sql += " WHERE " + " AND ".join(where)
+
+        with self._db_engine.connect() as conn:
+            try:
+                result = conn.execution_options(stream_results=True).execute(sql)
+            except Exception as e:
+                raise Exception(f"ERROR: Failed to query labs: {e}")
+
+            while True:
+                rows = result.fetchmany(batch_size)
+                if not rows:
+                    break
+
+                for row in rows:
+                    yield row_type._make(row)
+
+    def get_scheduled_labs(self, starting=None, columns=None):
+        if columns:
+            return list(self.iter_labs(columns, status="SCHEDULED", starting=starting))
+
         sql = f"SELECT * from {LAB_TABLE} WHERE status='SCHEDULED'"
         if starting:
             sql += f" AND start_time <= '{starting}'"
@@ -55,6 +156,9 @@ class DB(object):
             else:
                 return [row for row in result]
 
+    def get_active_labs(self):
+        return self.iter_labs(("source", "start_time", "end_time", "duration"), status=ACTIVE_STATUSES)
+
     def get_lab(self, lid):
         sql = f"SELECT * from lab WHERE id='{lid}'"
         with self._db_engine.connect() as conn:
@@ -65,8 +169,11 @@ class DB(object):
             else:
                 return result.first()
 
-    def get_expired_labs(self):
+    def get_expired_labs(self, columns=None):
         now = datetime.datetime.now().strftime("%s")
+        if columns:
+            return list(self.iter_labs(columns, status="RUNNING", ending=now))
+
         sql = f"SELECT * from {LAB_TABLE} WHERE status='RUNNING' AND end_time <= '{now}'"
 
         with self._db_engine.connect() as conn:
@@ -77,17 +184,69 @@ class DB(object):
             else:
                 return [row for row in result]
 
+    def get_running_labs(self, columns):
+        return list(self.iter_labs(columns, status="RUNNING"))
+
     def get_labs_with_schedule_id(self, schedule_id):
-        sql = f"SELECT * from {LAB_TABLE} WHERE schedule_id='{schedule_id}'"
+        try:
+            return self.get_all_labs(schedule_id=schedule_id)
+        except Exception as e:
+            raise Exception(f"ERROR: Failed to get labs with schedule ID: {e}")
+
+    def get_all_labs(self, student=None, schedule_id=None):
+        """Report on both live and compacted labs.  Compacted labs always have a status of HISTORIC."""
+        where = []
+        if student:
+            where.append(f"student='{student}'")
+        if schedule_id:
+            where.append(f"schedule_id='{schedule_id}'")
+
+        cond = ""
+        if len(where) > 0:
+            cond = " WHERE " + " AND ".join(where)
+
+        sql = f"SELECT id, {HISTORY_COLUMNS}, status from {LAB_TABLE}{cond} UNION ALL \
+            SELECT lab_id AS id, {HISTORY_COLUMNS}, 'HISTORIC' AS status from {LAB_HISTORY_TABLE}{cond} ORDER BY start_time, id"
 
         with self._db_engine.connect() as conn:
             try:
                 result = conn.execute(sql)
             except Exception as e:
-                raise Exception(f"ERROR: Failed to get labs with schedule ID: {e}")
+                raise Exception(f"ERROR: Failed to get labs: {e}")
             else:
                 return [row for row in result]
 
+    def compact_labs(self):
+        """Move all HISTORIC labs into the history table.  Returns the number of labs moved."""
+        with self._db_engine.connect() as conn:
+            try:
+                with conn.begin():
+                    conn.execute(
+                        f"INSERT INTO {LAB_HISTORY_TABLE} (lab_id, {HISTORY_COLUMNS}) SELECT id, {HISTORY_COLUMNS} from {LAB_TABLE} \
+                        WHERE status='HISTORIC'"
+                    )
+                    result = conn.execute(f"DELETE FROM {LAB_TABLE} WHERE status='HISTORIC'")
+            except Exception as e:
+                raise Exception(f"ERROR: Failed to compact labs: {e}")
+            else:
+                return result.rowcount
+
+    def get_lab_index(self, lid, schedule_id):
+        """
+        Return the 1-based position of a lab among the labs scheduled with the same schedule ID, counting the labs that
+        are left.  This is only for labs scheduled without a lab_index: removing a lab shifts the index of every later
+        lab in its schedule.
+        """
+        sql = f"SELECT (SELECT COUNT(*) FROM {LAB_TABLE} WHERE schedule_id='{schedule_id}' AND id < '{lid}') + \
+            (SELECT COUNT(*) FROM {LAB_HISTORY_TABLE} WHERE schedule_id='{schedule_id}' AND lab_id < '{lid}')"
+        with self._db_engine.connect() as conn:
+            try:
+                result = conn.execute(sql)
+            except Exception as e:
+                raise Exception(f"ERROR: Failed to get lab index: {e}")
+            else:
+                return result.scalar() + 1
+
     def get_student(self, student):
         sql = f"SELECT * FROM {STUDENT_TABLE} where uname='{student}'"
         with self._db_engine.connect() as conn:
@@ -119,14 +278,20 @@ class DB(object):
                 except Exception as e:
                     raise Exception(f"ERROR: Failed to delete lab: {e}")
 
-    def schedule_lab(self, schedule_id, title, source, student, device_password, start_time, duration):
+    def schedule_lab(self, schedule_id, title, source, student, device_password, start_time, duration, lab_index=None):
         sobj = self.get_student(student)
         if not sobj:
             raise Exception(f"ERROR: Failed to find student {student} in the DB")
 
         with self._db_engine.connect() as conn:
-            sql = f"INSERT INTO lab (schedule_id, student, device_password, title, source, start_time, duration) VALUES ('{schedule_id}', \
-                '{student}', '{device_password}', '{title}', '{source}', '{start_time}', '{duration}')"
+            index = "NULL" if lab_index is None else int(lab_index)
+            # SQLite would hand out max(id) + 1, reusing the IDs of labs that have been compacted, so IDs continue from
+            # the highest one in either table.
+            lid = f"(SELECT COALESCE(MAX(id), 0) + 1 FROM (SELECT MAX(id) AS id FROM {LAB_TABLE} UNION ALL \
+                SELECT MAX(lab_id) FROM {LAB_HISTORY_TABLE}))"
+            sql = f"INSERT INTO {LAB_TABLE} (id, schedule_id, student, device_password, title, source, start_time, duration, lab_index) \
+                VALUES ({lid}, '{schedule_id}', '{student}', '{device_password}', '{title}', '{source}', '{start_time}', '{duration}', \
+                {index})"
             try:
                 result = conn.execute(sql)
             except Exception as e:
@@ -0,0 +1,170 @@
+import contextlib
+import cProfile
+import io
+import json
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+
+# Keep this many of the most recent samples per stage in timings.json.
+MAX_TIMING_SAMPLES = 1000
+# From Python 3.12, cProfile hooks into sys.monitoring, which is process-wide: a profiler sees every thread, and only
+# one can be active at a time.  Separate per-job profiles are then impossible, so the whole wave shares one.
+PER_JOB_PROFILES = sys.version_info < (3, 12)
+
+
+class JobProfiler(object):
+    """
+    Opt-in profiler for the jobs the deploy and stop scripts run in their thread pools.  Each job's queue wait, queue
+    depth, wall and CPU time, and per-stage latencies are recorded.  At the end of a wave, an aggregated profile
+    (aggregate.prof and a readable aggregate.txt) and jobs.json are written under <directory>/<phase>-<timestamp>/.
+    Up to Python 3.11, each job runs under its own cProfile profiler and its profile is written there too; from 3.12
+    on, a single profiler covers the whole wave, so there are no per-job profiles.  Stage latencies are also added to
+    <directory>/timings.json, which simulate-schedule.py can read with --timings.
+
+    With no directory, the profiler is disabled and only passes jobs through to the executor.
+    """
+
+    def __init__(self, directory, phase):
+        self._directory = directory
+        self._phase = phase
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._wave_dir = None
+        self._wave_profile = None
+        self._jobs = []
+        self._submitted = 0
+        self._started = 0
+
+    @property
+    def enabled(self):
+        return self._directory is not None
+
+    def start_wave(self):
+        if not self.enabled:
+            return
+
+        self._wave_dir = os.path.join(self._directory, f"{self._phase}-{time.strftime('%Y%m%d-%H%M%S')}")
+        os.makedirs(self._wave_dir, exist_ok=True)
+        self._jobs = []
+        self._submitted = 0
+        self._started = 0
+        if not PER_JOB_PROFILES:
+            self._wave_profile = cProfile.Profile()
+            self._wave_profile.enable()
+
+    def submit(self, executor, name, fn, *args):
+        if not self.enabled:
+            return executor.submit(fn, *args)
+
+        with self._lock:
+            self._submitted += 1
+
+        return executor.submit(self._run, name, time.monotonic(), fn, *args)
+
+    def _run(self, name, submitted, fn, *args):
+        start = time.monotonic()
+        with self._lock:
+            # Jobs submitted but not yet picked up by a worker, not counting this one.
+            depth = self._submitted - self._started - 1
+            self._started += 1
+
+        job = {"name": name, "queue_wait": start - submitted, "queue_depth": depth, "stages": {}, "error": None}
+        self._local.job = job
+        profile = None
+        if PER_JOB_PROFILES:
+            profile = cProfile.Profile()
+            profile.enable()
+
+        cpu = time.thread_time()
+        try:
+            return fn(*args)
+        except Exception as e:
+            job["error"] = str(e)
+            raise
+        finally:
+            job["cpu"] = time.thread_time() - cpu
+            job["wall"] = time.monotonic() - start
+            # Whatever the job's thread didn't spend on the CPU was spent waiting (mostly on the controller and SMTP).
+            job["wait"] = max(0, job["wall"] - job["cpu"])
+            if profile is not None:
+                profile.disable()
+                job["profile"] = os.path.join(self._wave_dir, re.sub(r"[^\w.-]", "_", name) + ".prof")
+                profile.dump_stats(job["profile"])
+
+            self._local.job = None
+            with self._lock:
+                self._jobs.append(job)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        job = getattr(self._local, "job", None)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            if job is not None:
+                job["stages"][name] = time.monotonic() - start
+
+    def end_wave(self):
+        if not self.enabled:
+            return
+
+        stats = None
+        if self._wave_profile is not None:
+            self._wave_profile.disable()
+            stats = pstats.Stats(self._wave_profile, stream=io.StringIO())
+            self._wave_profile = None
+        else:
+            profiles = [job["profile"] for job in self._jobs if "profile" in job]
+            if len(profiles) > 0:
+                stats = pstats.Stats(profiles[0], stream=io.StringIO())
+                for profile in profiles[1:]:
+                    stats.add(profile)
+
+        if len(self._jobs) == 0:
+            return
+
+        if stats is not None:
+            stats.dump_stats(os.path.join(self._wave_dir, "aggregate.prof"))
+            with open(os.path.join(self._wave_dir, "aggregate.txt"), "w") as fd:
+                stats.stream = fd
+                stats.sort_stats("cumulative").print_stats(50)
+
+        with open(os.path.join(self._wave_dir, "jobs.json"), "w") as fd:
+            json.dump(self._jobs, fd, indent=2)
+
+        self._record_timings()
+
+        wall = sum(job["wall"] for job in self._jobs)
+        cpu = sum(job["cpu"] for job in self._jobs)
+        queue_wait = max(job["queue_wait"] for job in self._jobs)
+        queue_depth = max(job["queue_depth"] for job in self._jobs)
+        print(
+            f"Profiled {len(self._jobs)} {self._phase} jobs in {self._wave_dir}: max queue wait {queue_wait:.1f}s, "
+            f"max queue depth {queue_depth}, {cpu:.1f}s CPU of {wall:.1f}s wall"
+        )
+
+    def _record_timings(self):
+        filename = os.path.join(self._directory, "timings.json")
+        timings = {}
+        if os.path.isfile(filename):
+            with open(filename, "r") as fd:
+                timings = json.load(fd)
+
+        stages = timings.setdefault(self._phase, {})
+        for job in self._jobs:
+            if job["error"]:
+                continue
+
+            for stage, latency in job["stages"].items():
+                stages.setdefault(stage, []).append(latency)
+
+        for stage, samples in stages.items():
+            stages[stage] = samples[-MAX_TIMING_SAMPLES:]
+
+        with open(filename, "w") as fd:
+            json.dump(timings, fd)
@@ -0,0 +1,394 @@
+from collections import deque
+import heapq
+import json
+import math
+import random
+
+POLL_INTERVAL = 60
+DEPLOY_STAGES = ["user", "import", "configure", "start", "address", "email"]
+STOP_STAGES = ["archive", "remove", "user"]
+
+# Rough per-stage latencies (in seconds) for a small lab.  Use recorded timings where they are available.
+DEFAULT_TIMINGS = {
+    "deploy": {
+        "user": {"mean": 0.5, "stddev": 0.2},
+        "import": {"mean": 2.0, "stddev": 0.5},
+        "configure": {"mean": 1.0, "stddev": 0.3},
+        "start": {"mean": 90.0, "stddev": 30.0},
+        "address": {"mean": 5.0, "stddev": 3.0},
+        "email": {"mean": 1.0, "stddev": 0.5},
+    },
+    "stop": {
+        "archive": {"mean": 30.0, "stddev": 10.0},
+        "remove": {"mean": 15.0, "stddev": 5.0},
+        "user": {"mean": 0.5, "stddev": 0.2},
+    },
+}
+
+
+class Distribution(object):
+    """
+    Latency distribution for one stage.  spec is either a number (a fixed latency), a list of recorded samples (drawn
+    from at random), or a dict with a mean and stddev (a lognormal with that mean and standard deviation).
+    """
+
+    def __init__(self, spec, rng):
+        self._rng = rng
+        if isinstance(spec, (int, float)):
+            self._sample = lambda: float(spec)
+        elif isinstance(spec, list):
+            if len(spec) == 0:
+                raise Exception("ERROR: A list of recorded timings must not be empty")
+            self._sample = lambda: rng.choice(spec)
+        elif isinstance(spec, dict) and "mean" in spec:
+            mean = float(spec["mean"])
+            stddev = float(spec.get("stddev", 0))
+            if mean <= 0 or stddev <= 0:
+                self._sample = lambda: max(mean, 0.0)
+            else:
+                sigma = math.sqrt(math.log(1 + (stddev / mean) ** 2))
+                mu = math.log(mean) - (sigma ** 2) / 2
+                self._sample = lambda: rng.lognormvariate(mu, sigma)
+        else:
+            raise Exception(f"ERROR: Invalid timing specification {spec}")
+
+    def sample(self):
+        return self._sample()
+
+
+def load_timings(filename=None):
+    """Return the default timings, overridden by any stages found in the given JSON file."""
+    timings = {phase: dict(stages) for phase, stages in DEFAULT_TIMINGS.items()}
+    if filename:
+        with open(filename, "r") as fd:
+            recorded = json.load(fd)
+
+        for phase, stages in recorded.items():
+            if phase not in timings:
+                raise Exception(f"ERROR: Unknown phase {phase} in timings (must be one of {', '.join(timings)})")
+
+            timings[phase].update(stages)
+
+    return timings
+
+
+class _Resource(object):
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.in_use = 0
+        self.peak = 0
+        self.waiters = deque()
+
+
+class Simulation(object):
+    """
+    Discrete-event model of the deploy-lab.py and stop-lab.py daemons.  Each daemon is replayed as it runs: it polls
+    once a minute, works through every lab that is due with a pool of workers, and only polls again once the whole wave
+    is done.  Labs hold their nodes on the controller from the start stage until they are removed, as do the labs that
+    are already running when the simulation starts.  When max_nodes would be exceeded, or max_booting labs are already
+    starting, a lab waits for capacity.
+
+    Processes are generators that yield ("delay", seconds), ("acquire", resource, amount), or ("join", [processes]).
+    """
+
+    def __init__(self, labs, timings=None, running=None, workers=20, max_nodes=None, max_booting=None, seed=None):
+        """
+        labs is a sequence of dicts (or rows) with id, title, student, start_time, duration (hours), and nodes.  running
+        is the same for labs already on the controller, which also need an end_time.
+        """
+        self._rng = random.Random(seed)
+        timings = timings or DEFAULT_TIMINGS
+        self._stages = {}
+        for phase, stages in (("deploy", DEPLOY_STAGES), ("stop", STOP_STAGES)):
+            self._stages[phase] = [(stage, Distribution(timings[phase][stage], self._rng)) for stage in stages]
+
+        self._labs = sorted(
+            (
+                {
+                    "id": lab["id"],
+                    "title": lab["title"],
+                    "student": lab["student"],
+                    "start_time": lab["start_time"],
+                    "duration": lab["duration"],
+                    "nodes": lab["nodes"],
+                }
+                for lab in labs
+            ),
+            key=lambda lab: lab["start_time"],
+        )
+        self._already_running = [
+            {
+                "id": lab["id"],
+                "title": lab["title"],
+                "student": lab["student"],
+                "end_time": lab["end_time"] if lab["end_time"] is not None else lab["start_time"] + (lab["duration"] * 60 * 60),
+                "nodes": lab["nodes"],
+            }
+            for lab in running or []
+        ]
+        self._workers = workers
+        self._nodes = _Resource(max_nodes if max_nodes is not None else math.inf)
+        self._booting = _Resource(max_booting if max_booting is not None else math.inf)
+        self._events = []
+        self._seq = 0
+        self._joiners = {}
+        self._now = 0
+        self._on_controller = 0
+        self._peak_labs = 0
+        self._peak_labs_time = None
+        # Running labs as a heap of (end_time, id, lab).
+        self._running = []
+        # Index of the next lab the deploy daemon has yet to pick up, and how many picked up labs have yet to start.
+        self._next = 0
+        self._deploying = 0
+        # No lab can expire sooner than its duration after it starts; _min_end[i] is the earliest that any lab from
+        # index i on could expire.
+        self._min_duration = min((lab["duration"] * 60 * 60 for lab in self._labs), default=0)
+        self._min_end = [0] * len(self._labs)
+        earliest = math.inf
+        for i in range(len(self._labs) - 1, -1, -1):
+            earliest = min(earliest, self._labs[i]["start_time"] + (self._labs[i]["duration"] * 60 * 60))
+            self._min_end[i] = earliest
+        self._max_backlog = 0
+        self._deploy_waves = 0
+        self._stop_waves = 0
+
+    def _schedule(self, when, proc):
+        self._seq += 1
+        heapq.heappush(self._events, (when, self._seq, proc))
+
+    def _spawn(self, gen):
+        self._schedule(self._now, gen)
+        return gen
+
+    def _step(self, proc):
+        try:
+            cmd = next(proc)
+        except StopIteration:
+            for joiner in self._joiners.pop(proc, []):
+                joiner["remaining"] -= 1
+                if joiner["remaining"] == 0:
+                    self._schedule(self._now, joiner["proc"])
+            return
+
+        if cmd[0] == "delay":
+            self._schedule(self._now + cmd[1], proc)
+        elif cmd[0] == "acquire":
+            resource, amount = cmd[1], cmd[2]
+            if len(resource.waiters) == 0 and resource.in_use + amount <= resource.capacity:
+                self._grant(resource, amount)
+                self._schedule(self._now, proc)
+            else:
+                resource.waiters.append((proc, amount))
+        elif cmd[0] == "join":
+            joiner = {"proc": proc, "remaining": len(cmd[1])}
+            for child in cmd[1]:
+                self._joiners.setdefault(child, []).append(joiner)
+
+    def _grant(self, resource, amount):
+        resource.in_use += amount
+        resource.peak = max(resource.peak, resource.in_use)
+
+    def _release(self, resource, amount):
+        resource.in_use -= amount
+        while len(resource.waiters) > 0 and resource.in_use + resource.waiters[0][1] <= resource.capacity:
+            proc, wamount = resource.waiters.popleft()
+            self._grant(resource, wamount)
+            self._schedule(self._now, proc)
+
+    def _next_poll(self, after, due):
+        """Skip idle polls: return the first poll at or after both after and due."""
+        if due <= after:
+            return after
+
+        return after + math.ceil((due - after) / POLL_INTERVAL) * POLL_INTERVAL
+
+    def _deploy_job(self, lab):
+        for stage, dist in self._stages["deploy"]:
+            if stage == "start":
+                if lab["nodes"] > self._nodes.capacity:
+                    lab["error"] = "lab needs more nodes than the controller allows"
+                    # The lab never starts (and so is never stopped), so stop counting it as on the controller.
+                    self._on_controller -= 1
+                    self._deploying -= 1
+                    return
+
+                lab["capacity_wait"] = self._now
+                yield ("acquire", self._nodes, lab["nodes"])
+                yield ("acquire", self._booting, 1)
+                lab["capacity_wait"] = self._now - lab["capacity_wait"]
+                yield ("delay", dist.sample())
+                self._release(self._booting, 1)
+                # run_lab() sets the end time as soon as the lab has started.
+                lab["end_time"] = self._now + (lab["duration"] * 60 * 60)
+                heapq.heappush(self._running, (lab["end_time"], lab["id"], lab))
+                self._deploying -= 1
+                continue
+
+            if stage == "import":
+                self._on_controller += 1
+                if self._on_controller > self._peak_labs:
+                    self._peak_labs = self._on_controller
+                    self._peak_labs_time = self._now
+
+            yield ("delay", dist.sample())
+
+        lab["ready_time"] = self._now
+
+    def _stop_job(self, lab):
+        lab["stop_time"] = self._now
+        for stage, dist in self._stages["stop"]:
+            yield ("delay", dist.sample())
+            if stage == "remove":
+                self._on_controller -= 1
+                self._release(self._nodes, lab["nodes"])
+
+        lab["removed_time"] = self._now
+
+    def _worker(self, queue, job):
+        while len(queue) > 0:
+            yield from job(queue.popleft())
+
+    def _wave(self, labs, job):
+        queue = deque(labs)
+        workers = [self._spawn(self._worker(queue, job)) for _ in range(min(self._workers, len(labs)))]
+        yield ("join", workers)
+
+    def _deploy_daemon(self):
+        labs = self._labs
+        while self._next < len(labs):
+            # Labs are picked up once their start time (to the minute) has passed.
+            minute = self._now - (self._now % 60)
+            first = self._next
+            while self._next < len(labs) and labs[self._next]["start_time"] <= minute:
+                self._next += 1
+
+            if first == self._next:
+                yield ("delay", self._next_poll(self._now + POLL_INTERVAL, labs[self._next]["start_time"]) - self._now)
+                continue
+
+            last = self._next
+            self._deploy_waves += 1
+            self._deploying += last - first
+            yield from self._wave(labs[first:last], self._deploy_job)
+
+    def _next_expiry(self):
+        """Return the earliest time any lab could expire (None if every lab has been stopped)."""
+        due = []
+        if len(self._running) > 0:
+            due.append(self._running[0][0])
+        if self._deploying > 0:
+            due.append(self._now + self._min_duration)
+        if self._next < len(self._labs):
+            due.append(self._min_end[self._next])
+
+        return min(due, default=None)
+
+    def _stop_daemon(self):
+        while True:
+            expired = []
+            while len(self._running) > 0 and self._running[0][0] <= self._now:
+                expired.append(heapq.heappop(self._running)[2])
+
+            if len(expired) > 0:
+                self._max_backlog = max(self._max_backlog, len(expired))
+                self._stop_waves += 1
+                yield from self._wave(expired, self._stop_job)
+                continue
+
+            due = self._next_expiry()
+            if due is None:
+                return
+
+            yield ("delay", self._next_poll(self._now + POLL_INTERVAL, due) - self._now)
+
+    def run(self):
+        if len(self._labs) == 0:
+            return SimulationResult([], 0, None, 0, 0, 0, 0)
+
+        self._now = self._labs[0]["start_time"]
+        for lab in self._already_running:
+            # Labs that end before the first scheduled lab starts will be gone by then.
+            if lab["end_time"] <= self._now:
+                continue
+
+            self._grant(self._nodes, lab["nodes"])
+            heapq.heappush(self._running, (lab["end_time"], lab["id"], lab))
+            self._on_controller += 1
+
+        if self._on_controller > 0:
+            self._peak_labs = self._on_controller
+            self._peak_labs_time = self._now
+
+        self._spawn(self._deploy_daemon())
+        self._spawn(self._stop_daemon())
+        while len(self._events) > 0:
+            self._now, _, proc = heapq.heappop(self._events)
+            self._step(proc)
+
+        return SimulationResult(
+            self._labs,
+            self._peak_labs,
+            self._peak_labs_time,
+            self._nodes.peak,
+            self._max_backlog,
+            self._deploy_waves,
+            self._stop_waves,
+        )
+
+
+class SimulationResult(object):
+    def __init__(self, labs, peak_labs, peak_labs_time, peak_nodes, max_backlog, deploy_waves, stop_waves):
+        self._labs = labs
+        self._peak_labs = peak_labs
+        self._peak_labs_time = peak_labs_time
+        self._peak_nodes = peak_nodes
+        self._max_backlog = max_backlog
+        self._deploy_waves = deploy_waves
+        self._stop_waves = stop_waves
+
+    @property
+    def labs(self):
+        """Per-lab results: time_to_ready and teardown_lag are in seconds (None if the lab never got that far)."""
+        results = []
+        for lab in self._labs:
+            ready = lab.get("ready_time")
+            removed = lab.get("removed_time")
+            results.append(
+                {
+                    "id": lab["id"],
+                    "title": lab["title"],
+                    "student": lab["student"],
+                    "start_time": lab["start_time"],
+                    "time_to_ready": ready - lab["start_time"] if ready is not None else None,
+                    "capacity_wait": lab.get("capacity_wait", 0),
+                    "teardown_lag": removed - lab["end_time"] if removed is not None else None,
+                    "error": lab.get("error"),
+                }
+            )
+
+        return results
+
+    @property
+    def peak_labs(self):
+        return self._peak_labs
+
+    @property
+    def peak_labs_time(self):
+        return self._peak_labs_time
+
+    @property
+    def peak_nodes(self):
+        return self._peak_nodes
+
+    @property
+    def max_teardown_backlog(self):
+        return self._max_backlog
+
+    @property
+    def deploy_waves(self):
+        return self._deploy_waves
+
+    @property
+    def stop_waves(self):
+        return self._stop_waves
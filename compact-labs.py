@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+
+from cml_auto import Config, DB
+import argparse
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move finished labs out of the live lab table and into the lab history")
+    parser.add_argument("--config", "-c", help="Path to CML automation config file (default: ./config.json)", default="./config.json")
+
+    args = parser.parse_args()
+
+    config = Config(args.config)
+    db = DB(config.db_file)
+
+    try:
+        count = db.compact_labs()
+    except Exception as e:
+        print(e)
+        exit(1)
+    else:
+        print(f"Moved {count} finished labs to the lab history")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 
-from cml_auto import Config, DB, CML, LabDef
+from cml_auto import Config, DB, CML, LabDef, JobProfiler, configure_requests_from
 import datetime
 import argparse
 import os
@@ -15,6 +15,7 @@ from email.mime.text import MIMEText
 from email.mime.image import MIMEImage
 
 CREATED_USERS = {}
+LAB_COLUMNS = ("id", "title", "student", "source", "schedule_id", "device_password", "lab_index")
 
 
 def email_student(student, pw, lab, lab_file, mgmtip, consoles, config):
@@ -66,7 +67,7 @@ def get_student_password():
     return "".join(random.choice(chrs) for i in range(8))
 
 
-def deploy_lab(lab, config, cml, db):
+def deploy_lab(lab, config, cml, db, discovery, profiler):
     global CREATED_USERS
 
     print(f"Deploying lab {lab['title']} for student {lab['student']}...")
@@ -81,25 +82,42 @@ def deploy_lab(lab, config, cml, db):
         if not os.path.isdir(cfg_dir):
             raise Exception(f"ERROR: {cfg_dir} is not a directory")
 
-        student = cml.get_student(lab["student"])
-        if lab["student"] not in CREATED_USERS and student:
-            cml.remove_student(lab["student"])
-
-        sobj = db.get_student(lab["student"])
-        if lab["student"] not in CREATED_USERS:
-            pw = get_student_password()
-            cml.add_student(lab["student"], sobj["name"], pw)
-            CREATED_USERS[lab["student"]] = pw
-        else:
-            pw = CREATED_USERS[lab["student"]]
-
-        scml = CML(config.cml_server, lab["student"], pw)
-        lid = scml.import_lab(lfile, title=lab["title"])
-
-        scml.configure_lab(lid, sobj["uname"], sobj["name"], pw, cfg_dir)
-        scml.start_lab(lid)
+        with profiler.stage("user"):
+            student = cml.get_student(lab["student"])
+            if lab["student"] not in CREATED_USERS and student:
+                cml.remove_student(lab["student"])
+
+            sobj = db.get_student(lab["student"])
+            if lab["student"] not in CREATED_USERS:
+                pw = get_student_password()
+                cml.add_student(lab["student"], sobj["name"], pw)
+                CREATED_USERS[lab["student"]] = pw
+            else:
+                pw = CREATED_USERS[lab["student"]]
+
+        with profiler.stage("import"):
+            scml = CML(config.cml_server, lab["student"], pw)
+            lid = scml.import_lab(lfile, title=lab["title"])
+
+        with profiler.stage("configure"):
+            lab_index = lab["lab_index"]
+            if lab_index is None:
+                # Scheduled before lab_index was stored.
+                lab_index = db.get_lab_index(lab["id"], lab["schedule_id"])
+
+            variables = {
+                "device_password": lab["device_password"],
+                "lab_index": lab_index,
+                "lab_title": lab["title"],
+            }
+            scml.configure_lab(lid, sobj["uname"], sobj["name"], pw, cfg_dir, variables)
+        with profiler.stage("start"):
+            scml.start_lab(lid)
         slab = db.run_lab(lab["id"], lid, pw)
-        email_student(sobj, pw, slab, lfile, scml.get_lab_address(lid), scml.get_lab_consoles(), config)
+        with profiler.stage("address"):
+            mgmtip = discovery.get_lab_address(lid)
+        with profiler.stage("email"):
+            email_student(sobj, pw, slab, lfile, mgmtip, scml.get_lab_consoles(), config)
     except Exception:
         db.unschedule(lab["id"])
         raise
@@ -108,15 +126,20 @@ def deploy_lab(lab, config, cml, db):
 def main():
     parser = argparse.ArgumentParser(description="Start a scheduled lab")
     parser.add_argument("--config", "-c", help="Path to CML automation config file (default: ./config.json)", default="./config.json")
+    parser.add_argument(
+        "--profile", "-p", help="Profile each lab deployment and write the results to this directory (default: profile_dir from the config)"
+    )
 
     args = parser.parse_args()
     config = Config(args.config)
     db = DB(config.db_file)
+    profiler = JobProfiler(args.profile or config.profile_dir, "deploy")
+    configure_requests_from(config)
 
     while True:
 
         now = datetime.datetime.strptime(datetime.datetime.now().strftime("%Y-%m-%d %H:%M"), "%Y-%m-%d %H:%M").strftime("%s")
-        labs = db.get_scheduled_labs(starting=now)
+        labs = db.get_scheduled_labs(starting=now, columns=LAB_COLUMNS)
         if (labs and len(labs) == 0) or not labs:
             time.sleep(60)
             continue
@@ -124,15 +147,22 @@ def main():
         print(f"Deploying {len(labs)} new labs for {now}")
 
         cml = CML(config.cml_server, config.cml_username, config.cml_password)
+        discovery = cml.discover_lab_addresses(interval=config.address_poll_interval, timeout=config.address_timeout)
 
+        profiler.start_wave()
         with concurrent.futures.ThreadPoolExecutor(max_workers=20) as executor:
-            future_labs = {executor.submit(deploy_lab, lab, config, cml, db): lab for lab in labs}
+            future_labs = {
+                profiler.submit(executor, f"{lab['title']}-{lab['student']}", deploy_lab, lab, config, cml, db, discovery, profiler): lab
+                for lab in labs
+            }
             for fl in concurrent.futures.as_completed(future_labs):
                 try:
                     fl.result()
                 except Exception as e:
                     print(e)
 
+        profiler.end_wave()
+
         print(f"DONE deploying labs for {now}")
 
 
@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+
+from cml_auto import Config, ArchiveIndex
+import argparse
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Index (or re-index) the node configurations in all lab archives")
+    parser.add_argument("--config", "-c", help="Path to CML automation config file (default: ./config.json)", default="./config.json")
+
+    args = parser.parse_args()
+
+    config = Config(args.config)
+
+    try:
+        index = ArchiveIndex(config.archive_index)
+        count = index.update(config.archives_base)
+    except Exception as e:
+        print(e)
+        exit(1)
+    else:
+        print(f"Indexed {count} new or changed archives")
+
+
+if __name__ == "__main__":
+    main()
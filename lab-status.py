@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+from cml_auto import Config, DB, CML, configure_requests_from
+import argparse
+import concurrent.futures
+import json
+import time
+
+LAB_COLUMNS = ("id", "cid", "title", "student", "end_time")
+
+
+def get_status(lab, cml):
+    status = {"id": lab["id"], "cid": lab["cid"], "title": lab["title"], "student": lab["student"], "end_time": lab["end_time"]}
+    try:
+        status.update(cml.get_lab_status(lab["cid"]))
+    except Exception as e:
+        status["error"] = str(e)
+
+    return status
+
+
+def get_statuses(labs, cml, workers):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        statuses = list(executor.map(lambda lab: get_status(lab, cml), labs))
+
+    return sorted(statuses, key=lambda s: (s["title"], s["student"]))
+
+
+def print_table(statuses):
+    fmt = "{:<6} {:<16} {:<32} {:<8} {:<16} {}"
+    print(fmt.format("ID", "STUDENT", "TITLE", "BOOTED", "ADDRESS", "ENDS"))
+    for status in statuses:
+        if "error" in status:
+            booted = "ERROR"
+            address = status["error"]
+        else:
+            booted = f"{status['booted']}/{len(status['nodes'])}"
+            address = status["address"] or "-"
+
+        print(fmt.format(status["id"], status["student"], status["title"], booted, address, time.ctime(status["end_time"])))
+
+    up = len([s for s in statuses if "error" not in s and s["booted"] == len(s["nodes"]) and s["address"]])
+    print(f"{up} of {len(statuses)} running labs are fully booted and reachable")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Show the status of all running labs")
+    parser.add_argument("--config", "-c", help="Path to CML automation config file (default: ./config.json)", default="./config.json")
+    parser.add_argument("--json", "-j", help="Print the status as JSON instead of a table", action="store_true")
+    parser.add_argument("--watch", "-w", help="Refresh the status every WATCH seconds", type=int)
+    parser.add_argument("--workers", help="Number of labs to query at once (default: 20)", type=int, default=20)
+
+    args = parser.parse_args()
+
+    config = Config(args.config)
+    db = DB(config.db_file)
+    configure_requests_from(config)
+    cml = CML(config.cml_server, config.cml_username, config.cml_password)
+
+    while True:
+        labs = db.get_running_labs(columns=LAB_COLUMNS)
+        statuses = get_statuses(labs, cml, args.workers)
+        if args.json:
+            print(json.dumps(statuses, indent=2))
+        else:
+            print_table(statuses)
+
+        if not args.watch:
+            break
+
+        time.sleep(args.watch)
+
+
+if __name__ == "__main__":
+    main()
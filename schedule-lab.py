@@ -1,10 +1,22 @@
 #!/usr/bin/env python
 
-from cml_auto import Config, DB, LabDef, LabConfig
+from cml_auto import Config, DB, LabDef, LabConfig, CapacityIndex, get_node_cost
 import argparse
 import time
 
 
+def build_capacity_index(config, db):
+    index = CapacityIndex(config.max_nodes)
+    for lab in db.get_active_labs():
+        end_time = lab["end_time"]
+        if end_time is None:
+            end_time = lab["start_time"] + (lab["duration"] * 60 * 60)
+
+        index.add(lab["start_time"], end_time, get_node_cost(config.labs_directory, lab["source"]))
+
+    return index
+
+
 def main():
     parser = argparse.ArgumentParser(description="Schedule a lab to run in the future")
     parser.add_argument("--config", "-c", help="Path to CML automation config file (default: ./config.json)", default="./config.json")
@@ -27,9 +39,24 @@ def main():
         print("ERROR: This schedule has already been done.")
         exit(1)
 
+    if config.max_nodes is not None:
+        index = build_capacity_index(config, db)
+        end_time = lab_config.start_time + (lab_config.duration * 60 * 60)
+        cost = labdef.node_cost * len(lab_config.students)
+        if not index.fits(lab_config.start_time, end_time, cost):
+            peak = index.peak(lab_config.start_time, end_time)
+            print(f"ERROR: This schedule needs {cost} nodes, but {peak} of the {config.max_nodes} node limit are already in use then.")
+            slots = index.suggest(lab_config.start_time, end_time, cost)
+            if len(slots) > 0:
+                print("The following start times have enough capacity:")
+                for slot in slots:
+                    print(f"  {time.strftime('%Y-%m-%d %H:%M', time.localtime(slot))}")
+
+            exit(1)
+
     title = labdef.title.replace(" ", "_") + "-" + str(lab_config.start_time)
 
-    for student in lab_config.students:
+    for index, student in enumerate(lab_config.students, 1):
         try:
             db.schedule_lab(
                 lab_config.schedule_id,
@@ -39,6 +66,7 @@ def main():
                 lab_config.device_password,
                 lab_config.start_time,
                 lab_config.duration,
+                lab_index=index,
             )
         except Exception as e:
             print(e)
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+
+from cml_auto import Config, ArchiveIndex
+import argparse
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Search the node configurations in archived labs")
+    parser.add_argument("--config", "-c", help="Path to CML automation config file (default: ./config.json)", default="./config.json")
+    parser.add_argument("--node", "-n", help="Only search configurations of nodes with this label")
+    parser.add_argument("--lab", "-l", help="Only search labs whose title starts with this (e.g., STP_Lab)")
+    parser.add_argument("--student", "-s", help="Only search labs for this student")
+    parser.add_argument("--raw", "-r", help="Treat the query as an SQLite FTS5 expression instead of a phrase", action="store_true")
+    parser.add_argument("query", help="Text to search for (e.g., 'spanning-tree mode rapid-pvst')")
+
+    args = parser.parse_args()
+
+    config = Config(args.config)
+
+    try:
+        index = ArchiveIndex(config.archive_index)
+        rows = index.search(args.query, node=args.node, lab=args.lab, student=args.student, raw=args.raw)
+    except Exception as e:
+        print(e)
+        exit(1)
+
+    needle = args.query.lower()
+    for row in rows:
+        print(f"{row['lab']} {row['student']} {row['node']}")
+        if not args.raw:
+            for line in row["config"].splitlines():
+                if needle in line.lower():
+                    print(f"    {line.strip()}")
+
+    print(f"{len(rows)} matching node configurations")
+
+
+if __name__ == "__main__":
+    main()
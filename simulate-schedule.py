@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+from cml_auto import Config, DB, Simulation, get_node_cost, load_timings
+import argparse
+import json
+import time
+
+LAB_COLUMNS = ("id", "title", "student", "source", "start_time", "end_time", "duration", "schedule_id")
+
+
+def get_labs(config, db, status, schedule_id=None):
+    labs = []
+    for lab in db.iter_labs(LAB_COLUMNS, status=status):
+        if schedule_id and lab["schedule_id"] != schedule_id:
+            continue
+
+        labs.append(dict(lab._asdict(), nodes=get_node_cost(config.labs_directory, lab["source"])))
+
+    return labs
+
+
+def percentile(values, pct):
+    if len(values) == 0:
+        return None
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def fmt_secs(secs):
+    if secs is None:
+        return "-"
+
+    return f"{int(secs // 60)}m{int(secs % 60):02d}s"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate how the deploy and stop scripts will handle the scheduled labs")
+    parser.add_argument("--config", "-c", help="Path to CML automation config file (default: ./config.json)", default="./config.json")
+    parser.add_argument("--timings", "-t", help="JSON file of per-stage latencies (e.g., recorded by deploy-lab.py --profile)")
+    parser.add_argument("--schedule-id", "-s", help="Only simulate the labs with this schedule ID")
+    parser.add_argument("--workers", help="Number of labs each script handles at once (default: 20)", type=int, default=20)
+    parser.add_argument("--max-nodes", help="Maximum nodes the CML server can run at once (default: max_nodes from the config)", type=int)
+    parser.add_argument("--max-booting", help="Maximum labs the CML server can start at once (default: unlimited)", type=int)
+    parser.add_argument("--seed", help="Random seed, for repeatable results", type=int)
+    parser.add_argument("--json", "-j", help="Print the results as JSON", action="store_true")
+
+    args = parser.parse_args()
+
+    config = Config(args.config)
+    db = DB(config.db_file)
+
+    try:
+        timings = load_timings(args.timings)
+        labs = get_labs(config, db, "SCHEDULED", args.schedule_id)
+        # Running labs hold their nodes whichever schedule they are from.
+        running = get_labs(config, db, "RUNNING")
+    except Exception as e:
+        print(e)
+        exit(1)
+
+    max_nodes = args.max_nodes if args.max_nodes is not None else config.max_nodes
+    sim = Simulation(
+        labs, timings, running=running, workers=args.workers, max_nodes=max_nodes, max_booting=args.max_booting, seed=args.seed
+    )
+    result = sim.run()
+    ready = [lab["time_to_ready"] for lab in result.labs if lab["time_to_ready"] is not None]
+    lags = [lab["teardown_lag"] for lab in result.labs if lab["teardown_lag"] is not None]
+    summary = {
+        "labs": len(result.labs),
+        "failed": len([lab for lab in result.labs if lab["error"]]),
+        "time_to_ready_p50": percentile(ready, 50),
+        "time_to_ready_p95": percentile(ready, 95),
+        "time_to_ready_max": max(ready, default=None),
+        "peak_labs": result.peak_labs,
+        "peak_labs_time": result.peak_labs_time,
+        "peak_nodes": result.peak_nodes,
+        "max_teardown_backlog": result.max_teardown_backlog,
+        "teardown_lag_max": max(lags, default=None),
+        "deploy_waves": result.deploy_waves,
+        "stop_waves": result.stop_waves,
+    }
+
+    if args.json:
+        print(json.dumps({"summary": summary, "labs": result.labs}, indent=2))
+        return
+
+    fmt = "{:<6} {:<16} {:<32} {:<17} {:<10} {:<10} {}"
+    print(fmt.format("ID", "STUDENT", "TITLE", "START", "READY IN", "WAITED", "TEARDOWN LAG"))
+    for lab in result.labs:
+        print(
+            fmt.format(
+                lab["id"],
+                lab["student"],
+                lab["title"],
+                time.strftime("%Y-%m-%d %H:%M", time.localtime(lab["start_time"])),
+                lab["error"] or fmt_secs(lab["time_to_ready"]),
+                fmt_secs(lab["capacity_wait"]),
+                fmt_secs(lab["teardown_lag"]),
+            )
+        )
+
+    print()
+    print(f"Labs simulated: {summary['labs']} ({summary['failed']} could not be deployed)")
+    print(
+        f"Time to ready: p50 {fmt_secs(summary['time_to_ready_p50'])}, p95 {fmt_secs(summary['time_to_ready_p95'])}, "
+        f"max {fmt_secs(summary['time_to_ready_max'])}"
+    )
+    if result.peak_labs_time is not None:
+        print(f"Peak concurrency: {result.peak_labs} labs at {time.ctime(result.peak_labs_time)}, {result.peak_nodes} nodes")
+    print(f"Teardown: at most {result.max_teardown_backlog} labs waiting at once, max lag {fmt_secs(summary['teardown_lag_max'])}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,14 @@
 #!/usr/bin/env python
 
-from cml_auto import Config, DB, CML
+from cml_auto import Config, DB, CML, ArchiveIndex, JobProfiler, configure_requests_from
 import argparse
 import os
 import errno
 import concurrent.futures
 import time
 
+LAB_COLUMNS = ("id", "cid", "title", "student", "student_password", "device_password")
+
 
 # Taken from https://stackoverflow.com/a/600612/119527
 def mkdir_p(path):
@@ -19,47 +21,74 @@ def mkdir_p(path):
             raise  # noqa
 
 
-def stop_lab(lab, config, db):
+def stop_lab(lab, config, db, index, profiler):
     print(f"Stopping lab {lab['title']} for student {lab['student']}")
     archive_dir = config.archives_base + "/" + lab["title"] + "-" + lab["student"]
     scml = CML(config.cml_server, lab["student"], lab["student_password"])
     cml = CML(config.cml_server, config.cml_username, config.cml_password)
-    mkdir_p(archive_dir)
-    scml.archive_lab(lab["cid"], archive_dir + "/lab.yaml", lab["device_password"])
-    scml.remove_lab(lab["cid"])
-    try:
-        cml.remove_student(lab["student"])
-    except Exception:
-        # Student may have labs assigned still.
-        pass
+    with profiler.stage("archive"):
+        mkdir_p(archive_dir)
+        scml.archive_lab(lab["cid"], archive_dir + "/lab.yaml", lab["device_password"])
+        # Nothing is archived if the lab is already gone from the controller.
+        if os.path.isfile(archive_dir + "/lab.yaml"):
+            try:
+                index.add_archive(archive_dir + "/lab.yaml", lab["title"], lab["student"])
+            except Exception as e:
+                # The archive is still on disk; index-archives.py will pick it up later.
+                print(e)
+    with profiler.stage("remove"):
+        scml.remove_lab(lab["cid"])
+    with profiler.stage("user"):
+        try:
+            cml.remove_student(lab["student"])
+        except Exception:
+            # Student may have labs assigned still.
+            pass
     db.stop_lab(lab["id"])
 
 
 def main():
     parser = argparse.ArgumentParser(description="Stop a running lab")
     parser.add_argument("--config", "-c", help="Path to CML automation config file (default: ./config.json)", default="./config.json")
+    parser.add_argument(
+        "--profile", "-p", help="Profile each lab teardown and write the results to this directory (default: profile_dir from the config)"
+    )
 
     args = parser.parse_args()
 
     config = Config(args.config)
     db = DB(config.db_file)
+    profiler = JobProfiler(args.profile or config.profile_dir, "stop")
+    index = ArchiveIndex(config.archive_index)
+    configure_requests_from(config)
 
     while True:
-        labs = db.get_expired_labs()
+        labs = db.get_expired_labs(columns=LAB_COLUMNS)
         if (labs and len(labs) == 0) or not labs:
             time.sleep(60)
             continue
 
         print(f"Stopping {len(labs)} labs")
 
+        profiler.start_wave()
         with concurrent.futures.ThreadPoolExecutor(max_workers=20) as executor:
-            future_labs = {executor.submit(stop_lab, lab, config, db): lab for lab in labs}
+            future_labs = {
+                profiler.submit(executor, f"{lab['title']}-{lab['student']}", stop_lab, lab, config, db, index, profiler): lab
+                for lab in labs
+            }
             for fl in concurrent.futures.as_completed(future_labs):
                 try:
                     fl.result()
                 except Exception as e:
                     print(e)
 
+        profiler.end_wave()
+
+        try:
+            db.compact_labs()
+        except Exception as e:
+            print(e)
+
         print("DONE stopping labs; sleeping")
 
 